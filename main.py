@@ -6,8 +6,14 @@ import ujson
 import uasyncio
 import ntptime
 import ubinascii
+import gc
+import os
+import micropython
 from micropython import const
 
+# Reserve memory for exception tracebacks so errors can still be reported when the heap is exhausted
+micropython.alloc_emergency_exception_buf(100)
+
 # SSID (name) and password of your WiFi network
 __SSID, __PASSWORD = const('your SSID'), const('your password')
 # Ports used for socket communication (default 7776)
@@ -17,46 +23,125 @@ __PORT2 = const(7775)
 RELAY1 = machine.Pin(2, machine.Pin.OUT)
 RELAY2 = machine.Pin(3, machine.Pin.OUT)
 LED = machine.Pin("LED", machine.Pin.OUT)
+# Relays and the port that triggers each one, paired by index
+_RELAY_PINS = (RELAY1, RELAY2)
+_RELAY_PORTS = (__PORT1, __PORT2)
 # Enables logging to log.txt in root directory of Pico W
-# For testing/debugging purposes only, will eventually fill the board's 2 MB flash memory
-ENABLE_LOGGING = const(False)
+# For testing/debugging purposes only, adds wear to the board's flash memory
+_ENABLE_LOGGING = const(False)
+# Size in bytes at which log.txt is moved to log.1.txt and a new log is started, replacing the previous log.1.txt
+_MAX_LOG_SIZE = const(65536)
 # Enables setting system time from an NTP server for timestamped logging
-ENABLE_SYSTEM_TIME = const(False)
+_ENABLE_SYSTEM_TIME = const(False)
 # Enables a 2 second rapid blink of the Pico W's onboard LED when receiving command to turn on PC
-ENABLE_BLINKING = const(False)
+_ENABLE_BLINKING = const(False)
 # Time zone offset from UTC (e.g. -5 for EST)
-TIME_ZONE = const(-4)
+_TIME_ZONE = const(-4)
 # Max time in seconds before restarting attempt to connect to WiFi
-WIFI_TIMEOUT = const(10)
+_WIFI_TIMEOUT = const(10)
 # Time in milliseconds that the relay is activated each time command is received
-RELAY_TIME = const(200)
-# Asynchronous coroutine will check for WiFi connection drop every CHECK_TIME seconds, set to 0 to disable
-CHECK_TIME = const(180)
+_RELAY_TIME = const(200)
+# Asynchronous coroutine will check for WiFi connection drop every _CHECK_TIME seconds, set to 0 to disable
+_CHECK_TIME = const(180)
+# Parses commands with ujson instead of a fast byte scan, for debugging malformed packets
+_STRICT_JSON = const(False)
+# Serves every relay from the first port, with the command's "target" field (1, 2, ...) choosing the relay
+# Commands without a target always use the relay belonging to the port they arrive on
+_SINGLE_PORT = const(False)
 
 # Initialize WiFi functionality
 wlan = network.WLAN(network.STA_IF)
 wlan.active(True)
 wlan.config(pm = 0xa11140) # Disable power saving mode
 
-if ENABLE_LOGGING:
+if _ENABLE_LOGGING:
     log_file = open('log.txt', 'a')
 
-if ENABLE_SYSTEM_TIME:
+if _ENABLE_SYSTEM_TIME:
     time_is_set = False
 
-sockets_opened = False
-
-def _logger(*args, **kwargs):
-    data = ' '.join(str(arg) for arg in args)
-
-    if ENABLE_SYSTEM_TIME and time_is_set:
-        data = _to_iso8601(time.localtime(), TIME_ZONE, 0) + ': ' + data
-
-    print(data)
-
-    if ENABLE_LOGGING:
-        log_file.write(data + '\n')
-        log_file.flush()
+if _ENABLE_BLINKING:
+    _blink_timer, _blink_stop_timer = machine.Timer(), machine.Timer()
+
+# Log lines held in memory until they're written to log.txt, and their total length
+_log_buf = []
+_log_buf_len = 0
+# Buffered log lines are written once they reach _LOG_BUF_SIZE bytes or every _LOG_FLUSH_TIME seconds
+_LOG_BUF_SIZE = const(4096)
+_LOG_FLUSH_TIME = const(10)
+
+# Receive buffer shared by all receive_command tasks, allocated once to avoid heap churn per command
+# Only _read_command touches it, and it copies the data out before any other task can run
+_RECV_BUF = bytearray(1024)
+_RECV_MV = memoryview(_RECV_BUF)
+
+# Stands in for a "target" field whose value isn't a plain integer, never a valid relay number
+_INVALID_TARGET = const(-1)
+
+# Timestamp buffer filled in place by _to_iso8601 instead of formatting a new string each log line
+_TS_BUF = bytearray(b'0000-00-00T00:00:00')
+# Arguments and result of the last _to_iso8601 call, reused by log lines within the same second
+_ts_cache = [None, 0, 0, '']
+
+# UDP socket reused by every _ping call, the address it probes and the DNS query it sends (NS records of the root zone)
+_ping_sock = None
+try:
+    _PING_ADDR = socket.getaddrinfo('8.8.8.8', 53)[0][-1]
+except OSError:
+    _PING_ADDR = ('8.8.8.8', 53)
+_DNS_QUERY = b'\x00\x01\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x02\x00\x01'
+
+if _ENABLE_LOGGING or _ENABLE_SYSTEM_TIME:
+    def _logger(*args, **kwargs):
+        global _log_buf_len
+        timestamped = _ENABLE_SYSTEM_TIME and time_is_set
+
+        # Only printing, so let print() write the arguments without building a joined string
+        if not _ENABLE_LOGGING and not timestamped:
+            print(*args)
+            return
+
+        data = ' '.join(str(arg) for arg in args)
+
+        if timestamped:
+            data = _to_iso8601(time.localtime(), _TIME_ZONE, 0) + ': ' + data
+
+        print(data)
+
+        if _ENABLE_LOGGING:
+            _log_buf.append(data + '\n')
+            _log_buf_len += len(data) + 1
+            if _log_buf_len >= _LOG_BUF_SIZE:
+                _write_log()
+else:
+    # Nothing to timestamp or write to log.txt, so log lines go straight to print()
+    _logger = print
+
+def _write_log():
+    # Write out buffered log lines and flush once, so the flash is written once per batch rather than per line
+    global _log_buf_len
+    for line in _log_buf:
+        log_file.write(line)
+    log_file.flush()
+    _log_buf.clear()
+    _log_buf_len = 0
+
+    if log_file.tell() >= _MAX_LOG_SIZE:
+        _rotate_log()
+
+def _rotate_log():
+    # Keep only the current and previous log so logging can't fill the flash
+    global log_file
+    log_file.close()
+    try:
+        os.remove('log.1.txt')
+    except OSError:
+        pass
+    try:
+        os.rename('log.txt', 'log.1.txt')
+    except OSError:
+        pass # Keep appending to log.txt, rotation is retried after the next write
+    log_file = open('log.txt', 'a')
 
 async def attempt_connection(ssid, password):
     attempting_connection = True
@@ -66,53 +151,91 @@ async def attempt_connection(ssid, password):
         
         _logger('Waiting for WiFi connection...')
 
-        wifi_timeout = WIFI_TIMEOUT
+        wifi_timeout = _WIFI_TIMEOUT
         while not wlan.isconnected() and wifi_timeout > 0:
             wifi_timeout -= 1
             await uasyncio.sleep(1)
 
         if wlan.isconnected():
+            # Some firmware re-enables power saving when connecting, which adds latency to incoming packets
+            wlan.config(pm = 0xa11140) # Disable power saving mode
             network_parameters = wlan.ifconfig()
             _logger('Connection to', ssid, 'successfully established!', sep=' ')
             _logger('Local IP address: ' + network_parameters[0])
             _logger('MAC address: ' + ubinascii.hexlify(network.WLAN().config('mac'), ':').decode())
+            _logger('Signal strength: {} dBm'.format(wlan.status('rssi')))
             attempting_connection = False
         else:
             _logger('Connection failed, reattempting...')
             await uasyncio.sleep(1)
 
+async def flush_log():
+    while True:
+        await uasyncio.sleep(_LOG_FLUSH_TIME)
+        if _log_buf:
+            _write_log()
+
 async def check_connection(ssid, password):
     while True:
         if not _ping():
             _logger('WiFi connection dropped or network is offline. Attempting reconnection...')
             await attempt_connection(ssid, password)
         
-        await uasyncio.sleep(CHECK_TIME)
+        await uasyncio.sleep(_CHECK_TIME)
     
-def _ping(host='8.8.8.8', port=53, timeout=3):
+def _ping(addr=_PING_ADDR, timeout=3):
+    # No socket needed to tell that the WiFi link itself is down
+    if not wlan.isconnected():
+        return False
+
+    global _ping_sock
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(timeout)
-        s.connect((host, port))
-        s.close()
+        # A DNS query over UDP needs no handshake, so one socket can be kept for every check
+        if _ping_sock == None:
+            _ping_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _ping_sock.settimeout(timeout)
+        _ping_sock.sendto(_DNS_QUERY, addr)
+        _ping_sock.recv(12) # Any reply means the server is reachable
         return True
     except OSError as e:
+        if _ping_sock != None:
+            _ping_sock.close()
+            _ping_sock = None
         return False
 
+def _blinkLED(led, ticks_100ms):
+    # Timers toggle the LED and end the blink in the background, so no task wakes during it
+    # A command arriving mid-blink restarts the blink rather than starting a second one
+    _blink_timer.init(mode=machine.Timer.PERIODIC, period=50, callback=lambda t: led.toggle())
+    _blink_stop_timer.init(mode=machine.Timer.ONE_SHOT, period=ticks_100ms * 100, callback=lambda t: _stop_blink(led))
 
-async def _blinkLED(led, seconds):
-    for i in range(int(seconds * 10)):
-        led.value(1)
-        await uasyncio.sleep_ms(50)
-        led.value(0)
-        await uasyncio.sleep_ms(50)
+def _stop_blink(led):
+    _blink_timer.deinit()
+    led.value(0)
 
+@micropython.native
 def _to_iso8601(local_time_tuple, tz_offset_hours=0, tz_offset_minutes=0):
+    cache = _ts_cache
+    if cache[0] == local_time_tuple and cache[1] == tz_offset_hours and cache[2] == tz_offset_minutes:
+        return cache[3]
+
     # Adjust hours and minutes for timezone offset
     year, month, day, hour, minute, second, _, _ = local_time_tuple
-    hour += tz_offset_hours
-    minute += tz_offset_minutes
-    
+    packed = _normalize_time(day, hour + tz_offset_hours, minute + tz_offset_minutes)
+    day, hour, minute = packed >> 16, (packed >> 8) & 0xff, packed & 0xff
+
+    _put_digits(_TS_BUF, 4, year, 4)
+    _put_digits(_TS_BUF, 7, month, 2)
+    _put_digits(_TS_BUF, 10, day, 2)
+    _put_digits(_TS_BUF, 13, hour, 2)
+    _put_digits(_TS_BUF, 16, minute, 2)
+    _put_digits(_TS_BUF, 19, second, 2)
+
+    cache[0], cache[1], cache[2], cache[3] = local_time_tuple, tz_offset_hours, tz_offset_minutes, str(_TS_BUF, 'ascii')
+    return cache[3]
+
+@micropython.viper
+def _normalize_time(day: int, hour: int, minute: int) -> int:
     # Handle overflow/underflow in hours and minutes
     if minute >= 60:
         hour += 1
@@ -125,111 +248,182 @@ def _to_iso8601(local_time_tuple, tz_offset_hours=0, tz_offset_minutes=0):
         day += 1
         hour -= 24
     elif hour < 0:
-        day -= 1 
+        day -= 1
         hour += 24
-    
-    return "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}".format(year, month, day, hour, minute, second)
 
-async def receive_command(relay, socket, port):
+    # Pack the results into one int so no tuple has to be allocated
+    return (day << 16) | (hour << 8) | minute
+
+@micropython.native
+def _put_digits(buf, end, value, width):
+    # Write value as zero-padded decimal digits into buf, ending just before index end
+    for i in range(width):
+        end -= 1
+        buf[end] = 48 + value % 10 # ASCII '0' + digit
+        value //= 10
+
+async def relay_worker(relay, event):
+    # Pulse the relay each time a command sets the event, commands arriving mid-pulse are merged into it
+    set_relay, sleep_ms = relay.value, uasyncio.sleep_ms
+
     while True:
-        conn, addr, data, command = None, None, None, None
+        await event.wait()
+        set_relay(1)
+        await sleep_ms(_RELAY_TIME)
+        set_relay(0)
+        event.clear()
+
+async def _read_command(reader):
+    # Read and copy out of the shared buffer with no scheduling point in between, so another
+    # connection's read can't overwrite the data before it's copied
+    n = await reader.readinto(_RECV_BUF)
+    return bytes(_RECV_MV[:n]) if n else b''
+
+def _parse_target(data):
+    # Read the relay number from a "target": N field without running the JSON parser
+    # Returns None if there's no such field or it's null, _INVALID_TARGET if it isn't a plain integer
+    i = data.find(b'"target"')
+    while i >= 0:
+        i += 8
+        while i < len(data) and data[i] == 32: # Skip spaces
+            i += 1
+        # Only a key is followed by ':', "target" anywhere else is part of a string value
+        if i < len(data) and data[i] == 58:
+            break
+        i = data.find(b'"target"', i)
+    if i < 0:
+        return None
+
+    end = i + 1
+    while end < len(data) and data[end] != 44 and data[end] != 125: # Up to ',' or '}'
+        end += 1
+    value = data[i + 1:end].strip()
+    if value == b'null':
+        return None
+    if not value:
+        return _INVALID_TARGET
+
+    number = 0
+    for c in value:
+        if not 48 <= c <= 57: # ASCII '0' to '9'
+            return _INVALID_TARGET
+        number = number * 10 + c - 48
+    return number
+
+async def receive_command(relay_events, relay_index, port, reader, writer):
+    command, target = None, None
 
+    try:
+        _logger('Connection on {} from {}'.format(port, writer.get_extra_info('peername')))
+
+        # Receive a command from the client, the read suspends until the socket is readable
+        # The 3 second deadline covers the whole read, so a peer that never sends can't hold the connection open
         try:
-            conn, addr = socket.accept()
-        except OSError as e:
-            if e.args[0] == 11: # EAGAIN
-                await uasyncio.sleep_ms(100)
+            data = await uasyncio.wait_for(_read_command(reader), 3)
+            if not data:
+                _logger('Connection closed by peer\n')
             else:
-                raise
-        
-        if conn != None:
-            _logger('Connection on {} from {}'.format(port, addr))
-
-            conn.settimeout(3)
-            # Receive a command from the client
-            while True:
-                try:
-                    data = conn.recv(1024)
-                    if data != None:
-                        try:
-                            data = data.decode()
-                            command = ujson.loads(data)
-                            break
-                        except ValueError as e:
-                            _logger('Invalid JSON received: {}'.format(e))
-                            break
-                    else:
-                        await uasyncio.sleep_ms(100)
-
-                except OSError as e:
-                    if e.args[0] == 110: # ETIMEDOUT
-                        _logger('Connection timed out, closing...\n')
-                        break
-                    if e.args[0] == 11: # EAGAIN
-                        await uasyncio.sleep_ms(100)
+                # The only command is {"gpio": "on"}, so scan for its tokens and only run the JSON parser if they're missing
+                if not _STRICT_JSON and b'"gpio"' in data and b'"on"' in data:
+                    command = 'on'
+                    target = _parse_target(data)
+                else:
+                    try:
+                        obj = ujson.loads(data)
+                    except ValueError as e:
+                        _logger('Invalid JSON received: {}'.format(e))
                     else:
-                        raise
+                        # Valid JSON that isn't an object (e.g. "on" or []) is reported as a bad packet
+                        if isinstance(obj, dict):
+                            command, target = obj.get('gpio', ''), obj.get('target')
+                            if target != None and type(target) is not int:
+                                target = _INVALID_TARGET
+                        else:
+                            command = ''
+        except uasyncio.TimeoutError:
+            _logger('Connection timed out, closing...\n')
+        except OSError as e:
+            _logger('Error receiving command: {}\n'.format(e))
 
-            # Excecute command to turn on PC
-            if command != None:
-                if command['gpio'] == 'on':
-                    _logger('Command received!')
-                    _logger('Turning PC on...\n')
+        # Excecute command to turn on PC
+        if command != None:
+            # A target that isn't a plain integer is rejected rather than falling back to the port's relay
+            if target != None:
+                relay_index = target - 1
 
-                    if ENABLE_BLINKING:
-                        uasyncio.create_task(_blinkLED(LED, 2))
+            if command == 'on' and not 0 <= relay_index < len(relay_events):
+                _logger('Invalid target received: {}\n'.format(target))
 
-                    relay.value(1)
-                    await uasyncio.sleep_ms(RELAY_TIME)
-                    relay.value(0)
+            elif command == 'on':
+                _logger('Command received!')
+                _logger('Turning PC on...\n')
 
-                else:
-                    _logger('Error reading data packet\n')
+                if _ENABLE_BLINKING:
+                    _blinkLED(LED, 20)
 
-            conn.close()
+                # The relay worker performs the pulse, so the connection can be closed right away
+                relay_events[relay_index].set()
+
+            else:
+                _logger('Error reading data packet\n')
+    finally:
+        # Always release the socket, lwIP only has a small fixed pool of them
+        writer.close()
+        await writer.wait_closed()
+
+    # Reclaim this command's transient allocations before the next connection
+    gc.collect()
 
 async def main():
+    servers = []
+
     try:
         _logger('Beginning a new session')
 
+        # Collect proactively once a quarter of the free heap has been allocated, before fragmentation builds up
+        gc.collect()
+        gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+
         await attempt_connection(__SSID, __PASSWORD)
 
-        if CHECK_TIME > 0:
+        if _CHECK_TIME > 0:
             uasyncio.create_task(check_connection(__SSID, __PASSWORD))
 
-        if ENABLE_SYSTEM_TIME:
+        if _ENABLE_LOGGING:
+            uasyncio.create_task(flush_log())
+
+        if _ENABLE_SYSTEM_TIME:
             ntptime.settime()
             global time_is_set
             time_is_set = True
             _logger('System time set!')
 
-        s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s1.setblocking(False)
-        s1.bind(('0.0.0.0', __PORT1))
-        s1.listen(1)
-        s2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s2.setblocking(False)
-        s2.bind(('0.0.0.0', __PORT2))
-        s2.listen(1)
-        global sockets_opened
-        sockets_opened = True
+        relay_events = tuple(uasyncio.Event() for relay in _RELAY_PINS)
+        for relay, relay_event in zip(_RELAY_PINS, relay_events):
+            uasyncio.create_task(relay_worker(relay, relay_event))
 
-        _logger('Waiting for a socket connection...\n')
+        for i, port in enumerate(_RELAY_PORTS[:1] if _SINGLE_PORT else _RELAY_PORTS):
+            # Listening sockets are registered with the uasyncio poller, which wakes a handler only when a client connects
+            servers.append(await uasyncio.start_server(
+                lambda r, w, i=i, p=port: receive_command(relay_events, i, p, r, w), '0.0.0.0', port, 1))
 
-        uasyncio.create_task(receive_command(RELAY1, s1, __PORT1))
-        uasyncio.create_task(receive_command(RELAY2, s2, __PORT2))
+        _logger('Waiting for a socket connection...\n')
 
-        while True:
-            await uasyncio.sleep(1)
+        # Park main without waking, the servers accept connections until they're cancelled
+        await uasyncio.gather(*(server.wait_closed() for server in servers))
 
     except Exception as e:
         _logger('An error occurred: ' + str(e))
         _logger('Ending session and restarting...\n\n')
-        if ENABLE_LOGGING:
-            log_file.close()
-        if sockets_opened:
-            s1.close()
-            s2.close()
+        if _ENABLE_LOGGING:
+            # A flash error here must not stop the board from restarting
+            try:
+                _write_log()
+                log_file.close()
+            except OSError:
+                pass
+        for server in servers:
+            server.close()
         machine.reset()
 
 if __name__ == "__main__":
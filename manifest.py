@@ -0,0 +1,3 @@
+# Freezes main.py into a custom MicroPython firmware image for the Pico W (see README)
+include("$(BOARD_DIR)/manifest.py")
+freeze(".", "main.py", opt=3)